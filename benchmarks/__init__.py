@@ -0,0 +1,56 @@
+"""Offline benchmarks for the imaging pipeline. Run them from the root of the
+repository, as the renderer loads its fonts and backgrounds relative to it:
+
+    python -m benchmarks.avatars
+    python -m benchmarks.render --players 5 25 --format webp
+    python -m benchmarks.backends --games 1 4 16
+"""
+from __future__ import annotations
+
+import io
+import random
+import statistics
+import time
+import typing
+
+from PIL import Image, ImageDraw
+
+
+def make_avatar(seed: int, size: int = 128) -> bytes:
+    """A PNG encoded avatar that looks enough like a real one to cost as much to
+    decode, some noise with a few shapes drawn over it"""
+    rand = random.Random(seed)
+    avy = Image.effect_noise((size, size), 40).convert("RGB")
+    raster = ImageDraw.Draw(avy)
+    for _ in range(6):
+        x, y = rand.randrange(size), rand.randrange(size)
+        r = rand.randrange(8, size // 2)
+        colour = tuple(rand.randrange(256) for _ in range(3))
+        raster.ellipse((x - r, y - r, x + r, y + r), fill=colour)
+
+    buf = io.BytesIO()
+    avy.save(buf, format="png")
+    return buf.getvalue()
+
+
+def percentile(samples: typing.List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def timed(func: typing.Callable[[], typing.Any], repeat: int) -> typing.List[float]:
+    """Runs func repeat times, returning how long each run took in milliseconds"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    return samples
+
+
+def summary(samples: typing.List[float]) -> str:
+    return (
+        f"p50 {statistics.median(samples):8.2f}ms  "
+        f"p95 {percentile(samples, 95):8.2f}ms"
+    )
@@ -0,0 +1,36 @@
+"""Compares rounding avatars one at a time against the batched NumPy path"""
+import argparse
+import io
+
+from benchmarks import make_avatar, summary, timed
+from utils import rendering
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--players", type=int, nargs="+", default=[5, 10, 25])
+    parser.add_argument("--repeat", type=int, default=30)
+    args = parser.parse_args()
+
+    # build the masks up front, they're only made once per worker
+    rendering.avatar_mask()
+
+    for players in args.players:
+        avatars = [make_avatar(seed) for seed in range(players)]
+
+        single = timed(
+            lambda: [rendering.round_avatar(io.BytesIO(avy)) for avy in avatars],
+            args.repeat,
+        )
+        batch = timed(lambda: rendering.round_avatars(avatars), args.repeat)
+
+        print(f"{players:>2} players")
+        print(f"  per avatar  {summary(single)}")
+        print(f"  batched     {summary(batch)}")
+        print(
+            f"  speedup     {sorted(single)[len(single) // 2] / sorted(batch)[len(batch) // 2]:.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
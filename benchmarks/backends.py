@@ -0,0 +1,121 @@
+"""Compares the render backends under load, by having a number of games ask for
+their day images at the same time and timing how long they take to come back"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+import typing
+
+from benchmarks import make_avatar, summary
+from utils import imaging
+
+# every game should pay for its avatars, and every render should be full size
+imaging.avatar_cache = None
+imaging.ADAPTIVE_RENDER = False
+
+
+class Avatar:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def read(self) -> bytes:
+        return self.data
+
+
+class Member:
+    def __init__(self, i: int):
+        self.id = i
+        self.name = f"player{i:03}"
+        self.nick = None
+        self.avatar = f"avatar{i}"
+        self._avatar = Avatar(make_avatar(i))
+
+    def avatar_url_as(self, **kwargs) -> Avatar:
+        return self._avatar
+
+
+class Role:
+    cleaned = False
+
+    def __str__(self):
+        return "Citizen"
+
+
+class Player:
+    def __init__(self, i: int):
+        self.member = Member(i)
+        self.dead = False
+        self.role = Role()
+
+
+class Game:
+    """Just enough of a MafiaGame for the render pool"""
+
+    def __init__(self, index: int, players: int):
+        self.players = [Player(index * 1000 + i) for i in range(players)]
+        self._day = 1
+
+
+async def bench(
+    backend: str, workers: int, games: int, players: int, rounds: int
+) -> typing.Tuple[typing.List[float], typing.List[float], float]:
+    """How long the first image took for each game (which includes sending the
+    avatars), how long every image after took, and the images per second"""
+    pool = imaging.RenderPool(workers, 4, backend=backend)
+    playing = [Game(i, players) for i in range(games)]
+
+    async def render(game: Game) -> float:
+        start = time.perf_counter()
+        buf = await pool.render_day(game, [])
+        buf.close()
+        return (time.perf_counter() - start) * 1000
+
+    first = await asyncio.gather(*map(render, playing))
+    later = []
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for game in playing:
+            game._day += 1
+        later.extend(await asyncio.gather(*map(render, playing)))
+    throughput = games * rounds / (time.perf_counter() - start)
+
+    for game in playing:
+        await pool.drop(game)
+    pool.close()
+    return first, later, throughput
+
+
+async def run(args: argparse.Namespace):
+    for games in args.games:
+        for backend in args.backends:
+            first, later, throughput = await bench(
+                backend, args.workers, games, args.players, args.rounds
+            )
+            print(f"{backend}, {games} games, {throughput:.2f} images/s")
+            print(f"  first       {summary(first)}")
+            print(f"  after       {summary(later)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=["process", "thread"],
+        choices=["process", "thread"],
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--games", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--players", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    # the same way the bot starts its workers
+    multiprocessing.set_start_method("forkserver")
+    multiprocessing.set_forkserver_preload(["utils.rendering"])
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Times each stage of rendering the day and night images for synthetic games"""
+import argparse
+import collections
+import random
+import time
+import typing
+
+from benchmarks import make_avatar, summary
+from utils import imaging, rendering
+
+# the disk cache would turn every avatar after the first run into a cache hit
+rendering.avatar_cache = None
+
+
+def make_game(players: int, state: str, seed: int = 0) -> typing.Tuple[dict, list]:
+    """A serialized game, the same shape the workers are sent, along with the ids
+    of the players who died last night. state is one of alive, mixed or dead"""
+    rand = random.Random(seed)
+    game = {
+        "d": 1 if state == "alive" else rand.randrange(2, 8),
+        "p": [
+            {
+                "ni": f"nickname{i}" if rand.random() < 0.5 else None,
+                "na": f"player{i:02}{'x' * rand.randrange(8)}",
+                "i": i,
+                "d": False,
+                "r": rand.choice(["Citizen", "Doctor", "Sheriff", "Mafia"]),
+                "c": False,
+                "a": make_avatar(seed * 100 + i),
+                "k": str(i),
+            }
+            for i in range(players)
+        ],
+    }
+
+    deaths = []
+    if state != "alive":
+        dying = rand.sample(game["p"], players // 2 if state == "mixed" else players)
+        for player in dying:
+            player["d"] = True
+            player["c"] = rand.random() < 0.2
+            if player["c"]:
+                player["r"] = "Cleaned"
+        # a couple of them only died last night
+        deaths = [player["i"] for player in dying[:2]]
+
+    return game, deaths
+
+
+class Stages:
+    """Collects how long each stage took across every run"""
+
+    def __init__(self):
+        self.samples: typing.Dict[str, typing.List[float]] = collections.defaultdict(
+            list
+        )
+        self.current: typing.Dict[str, float] = collections.defaultdict(float)
+
+    def time(self, stage: str, func: typing.Callable, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.current[stage] += (time.perf_counter() - start) * 1000
+        return result
+
+    def wrap(self, stage: str, func: typing.Callable) -> typing.Callable:
+        return lambda *args: self.time(stage, func, *args)
+
+    def finish(self):
+        for stage, ms in self.current.items():
+            self.samples[stage].append(ms)
+        self.current.clear()
+
+
+def bench_day(game: dict, deaths: list, repeat: int, tier: int) -> Stages:
+    stages = Stages()
+    for _ in range(repeat):
+        # a fresh game on a fresh worker, nothing is cached
+        rendering._backgrounds.clear()
+        rendering.day_layout.cache_clear()
+        stages.time("background", rendering.background, "day")
+        avatars = stages.time("avatars", rendering.load_avatars, game["p"])
+        stages.time("layout", rendering._day_slots, game, deaths)
+
+        renderer = rendering.DayRenderer(avatars)
+        # the labels and the title are the text, whatever else draw does is pasting
+        renderer._label = stages.wrap("text", renderer._label)
+        renderer._draw_title = stages.wrap("text", renderer._draw_title)
+        board = stages.time("draw", renderer.draw, game, deaths)
+        stages.current["paste"] = stages.current.pop("draw") - stages.current["text"]
+
+        stages.time("encode", rendering.encode_image, board, tier)
+        stages.current["total"] = sum(stages.current.values())
+        stages.finish()
+
+    return stages
+
+
+def bench_night(repeat: int) -> Stages:
+    stages = Stages()
+    for night in range(repeat):
+        rendering._backgrounds.clear()
+        stages.time("background", rendering.background, "night")
+        image = stages.time("text", rendering.draw_night_image, night + 1)
+        stages.time("encode", rendering.encode_image, image)
+        stages.current["total"] = sum(stages.current.values())
+        stages.finish()
+
+    return stages
+
+
+def report(name: str, stages: Stages):
+    print(name)
+    for stage, samples in stages.samples.items():
+        print(f"  {stage:<10}  {summary(samples)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--players", type=int, nargs="+", default=[2, 5, 10, 16, 25])
+    parser.add_argument(
+        "--states",
+        nargs="+",
+        default=["alive", "mixed"],
+        choices=["alive", "mixed", "dead"],
+    )
+    parser.add_argument("--format", choices=["png", "webp", "jpeg"])
+    parser.add_argument(
+        "--tier", type=int, default=0, help="index into imaging.RENDER_TIERS"
+    )
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.format:
+        imaging.OUTPUT_FORMAT = args.format
+    # the fonts and masks are only loaded once per worker, so they aren't timed
+    rendering.preload()
+
+    report("night", bench_night(args.repeat))
+    for players in args.players:
+        for state in args.states:
+            game, deaths = make_game(players, state)
+            report(
+                f"day, {players} players, {state}",
+                bench_day(game, deaths, args.repeat, args.tier),
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,8 @@ bot = MafiaBot(intents)
 
 if __name__ == "__main__":
     multiprocessing.set_start_method("forkserver")
+    # PIL and numpy get imported once in the forkserver instead of in every worker
+    multiprocessing.set_forkserver_preload(["utils.rendering"])
     for ext in glob("extensions/*.py"):
         bot.load_extension(ext.replace("/", ".")[:-3])
 
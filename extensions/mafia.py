@@ -5,7 +5,7 @@ from datetime import datetime
 import discord
 from discord.ext import commands, menus
 
-from utils import Cog, Context
+from utils import Cog, Context, cleanup_game
 from mafia import role_mapping, MafiaGame, Player, Role
 
 
@@ -76,6 +76,10 @@ class Mafia(Cog):
         except asyncio.TimeoutError:
             task.cancel()
             await ctx.send("Timed out waiting for players to join")
+        finally:
+            # however the game ended, the avatars of whoever joined were already
+            # sent to the renderer. Games that finish have done this already
+            await cleanup_game(game)
         # Remove game once it's done
         self.previous_games[ctx.guild.id] = game
         del self.games[ctx.guild.id]
@@ -1,6 +1,7 @@
 import asyncio
 import inspect
 import io
+import json
 import re
 import textwrap
 import traceback
@@ -9,6 +10,8 @@ from contextlib import redirect_stdout
 import discord
 from discord.ext import commands
 
+from utils.imaging import render_pool, render_stats
+
 
 def get_syntax_error(e):
     if e.text is None:
@@ -73,8 +76,8 @@ class Owner(commands.Cog, command_attrs={"hidden": True}):
 
         while True:
             try:
-                response = await ctx.bot.wait_for(
-                    "message", check=check, timeout=10.0 * 60.0
+                response = await ctx.bot.wait_for_message(
+                    msg.channel, author=msg.author, check=check, timeout=10.0 * 60.0
                 )
             except asyncio.TimeoutError:
                 await ctx.send("Exiting REPL session.")
@@ -228,6 +231,32 @@ class Owner(commands.Cog, command_attrs={"hidden": True}):
         await ctx.bot.change_presence(activity=discord.Game(name=status))
         await ctx.send("Just changed my status to '{}'!".format(status))
 
+    @commands.command()
+    async def renderstats(self, ctx, fmt: str = "text"):
+        """Shows how the render workers are doing, `json` sends every number as a file"""
+        stats = render_stats.dump(render_pool)
+        if fmt.lower() == "json":
+            buf = io.BytesIO(json.dumps(stats, indent=2).encode())
+            return await ctx.send(file=discord.File(buf, filename="render-stats.json"))
+
+        workers = stats["workers"]
+        lines = [
+            f"Workers ({workers['backend']}): {workers['alive']}/{workers['started']} alive (max {workers['size']})",
+            f"Games: {workers['games']}  Queued: {workers['queued']}  In flight: {workers['in_flight']}",
+            f"Day images at: {'x'.join(map(str, stats['tier']))}",
+            "",
+        ]
+        lines.extend(
+            f"{name}: {value}" for name, value in sorted(stats["counters"].items())
+        )
+        lines.append("")
+        for stage, t in sorted(stats["timings"].items()):
+            lines.append(
+                f"{stage:<13} p50 {t['p50']:8.1f}ms  p95 {t['p95']:8.1f}ms  ({t['samples']})"
+            )
+
+        await ctx.send("```\n{}\n```".format("\n".join(lines))[:2000])
+
     @commands.command()
     async def load(self, ctx, *modules: str):
         """Loads a module"""
@@ -23,6 +23,11 @@ from utils import (
     mafia_kill_check,
     get_mafia_player,
     cleanup_game,
+    discard_avatar,
+    image_filename,
+    prefetch_avatar,
+    RenderFailed,
+    send_image,
 )
 
 if typing.TYPE_CHECKING:
@@ -116,8 +121,13 @@ class MafiaGame:
 
     async def night_notification(self):
         async with self.chat.typing():
-            buffer = await create_night_image(self)
-            await self.info.send(file=discord.File(buffer, filename="night.png"))
+            try:
+                buffer = await create_night_image(self)
+            except RenderFailed:
+                await self.info.send(f"**Night {self._day - 1}**")
+            else:
+                # every game gets the same night images, they only need uploading once
+                await send_image(self.info, buffer, "night", self.ctx.bot)
             await self.chat.send(
                 "It's nighttime! Check your private channels if you have a task tonight"
             )
@@ -125,8 +135,37 @@ class MafiaGame:
     async def day_notification(self, *deaths: Player):
         """Creates a notification image with all of the overnight deaths"""
         async with self.info.typing():
-            buffer = await create_day_image(self, list(deaths))
-            await self.info.send(file=discord.File(buffer, filename="day.png"))
+            await self._send_day_image(list(deaths))
+
+    async def _send_day_image(self, deaths: typing.List[Player]):
+        try:
+            buffer = await create_day_image(self, deaths)
+        except RenderFailed:
+            # a bad render shouldn't hold up the game, send it as text instead
+            await self.info.send(self._day_summary(deaths))
+        else:
+            await self.info.send(
+                file=discord.File(buffer, filename=image_filename("day"))
+            )
+
+    def _day_summary(self, deaths: typing.List[Player]) -> str:
+        """The text version of the day image"""
+        alive = [p.member.display_name for p in self.players if not p.dead]
+        dead = [
+            f"{p.member.display_name} ({p})"
+            for p in self.players
+            if p.dead and p not in deaths
+        ]
+
+        msg = f"**Day {self._day}**\n"
+        if deaths:
+            died = ", ".join(f"{p.member.display_name} ({p})" for p in deaths)
+            msg += f"Died last night: {died}\n"
+        msg += f"Alive Players: {', '.join(alive)}\n"
+        if dead:
+            msg += f"Dead Players: {', '.join(dead)}"
+
+        return msg
 
     # Winner methods
 
@@ -276,14 +315,17 @@ class MafiaGame:
             "Starting new game of Mafia! Please first select how many players "
             "you want to allow to play the game at maximum?"
         )
-        answer = await ctx.bot.wait_for(
-            "message", check=min_max_check(ctx, minimum_players_needed, 25)
+        answer = await ctx.bot.wait_for_message(
+            ctx.channel,
+            author=ctx.author,
+            check=min_max_check(ctx, minimum_players_needed, 25),
         )
         max_players = int(answer.content)
         # Min players
         await ctx.send("How many players at minimum?")
-        answer = await ctx.bot.wait_for(
-            "message",
+        answer = await ctx.bot.wait_for_message(
+            ctx.channel,
+            author=ctx.author,
             check=min_max_check(ctx, minimum_players_needed, max_players),
         )
         min_players = int(answer.content)
@@ -347,6 +389,9 @@ class MafiaGame:
                     return False
                 if p.event_type == "REACTION_ADD":
                     game_players.add(p.user_id)
+                    # Get their avatar over to the renderer while everyone else joins
+                    if p.member is not None:
+                        prefetch_avatar(self, p.member)
                     # If we've hit the max, finish
                     if len(game_players) == max_players:
                         return True
@@ -356,6 +401,8 @@ class MafiaGame:
                         game_players.remove(p.user_id)
                     except KeyError:
                         pass
+                    else:
+                        discard_avatar(self, p.user_id)
 
                 return False
 
@@ -410,8 +457,10 @@ class MafiaGame:
         await ctx.send(
             f"How many mafia members (including special mafia members; Between 1 and {int(players / 2)})?"
         )
-        answer = await ctx.bot.wait_for(
-            "message", check=min_max_check(ctx, 1, int(players / 2))
+        answer = await ctx.bot.wait_for_message(
+            ctx.channel,
+            author=ctx.author,
+            check=min_max_check(ctx, 1, int(players / 2)),
         )
         amount_of_mafia = int(answer.content)
 
@@ -652,7 +701,7 @@ class MafiaGame:
             if player.executionor_target and not player.executionor_target.dead:
                 player.executionor_target.role = role_mapping["Jester"]()
 
-        task = create_day_image(self, list(killed.keys()))
+        task = self._send_day_image(list(killed.keys()))
 
         async with self.ctx.acquire() as conn:
             query = "INSERT INTO kills VALUES ($1, $2, $3, $4, $5)"
@@ -670,8 +719,7 @@ class MafiaGame:
             await self.chat.send("No one died last night!")
 
         # Wait for the task to get the image and send it
-        buff = await task
-        await self.info.send(file=discord.File(buff, filename="day.png"))
+        await task
 
     async def _day_discussion_phase(self):
         """Handles the discussion phase of the day"""
@@ -691,8 +739,8 @@ class MafiaGame:
         )
         nominations: typing.Dict[Player, Player] = {}
         try:
-            await self.ctx.bot.wait_for(
-                "message",
+            await self.ctx.bot.wait_for_message(
+                self.chat,
                 check=nomination_check(self, nominations),
                 timeout=30,
             )
@@ -741,7 +789,7 @@ class MafiaGame:
             "Make your votes now! Send either `Guilty` or `Innocent` to cast your vote"
         )
         try:
-            await self.ctx.bot.wait_for("message", check=check, timeout=30)
+            await self.ctx.bot.wait_for_message(self.chat, check=check, timeout=30)
         except asyncio.TimeoutError:
             pass
 
@@ -821,8 +869,9 @@ class MafiaGame:
             )
 
             async def mafia_check() -> None:
-                msg = await self.ctx.bot.wait_for(
-                    "message",
+                msg = await self.ctx.bot.wait_for_message(
+                    self.mafia_chat,
+                    author=godfather.member,
                     check=mafia_kill_check(self, mapping),
                 )
                 player = mapping[int(msg.content)]
@@ -905,7 +954,7 @@ class MafiaGame:
     # Cleanup
 
     async def cleanup(self):
-        cleanup_game(self)
+        await cleanup_game(self)
 
         for player in self.players:
             await player.member.remove_roles(self._alive_game_role)
@@ -175,8 +175,9 @@ class Player:
         _choices = "\n".join(f"{count}: {player}" for count, player in mapping.items())
         await self.channel.send(message + f". Choices are:\n{_choices}")
 
-        msg = await game.ctx.bot.wait_for(
-            "message",
+        msg = await game.ctx.bot.wait_for_message(
+            self.channel,
+            author=self.member,
             check=private_channel_check(game, self, mapping, not only_others),
         )
         player = mapping[int(msg.content)]
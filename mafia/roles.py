@@ -219,7 +219,9 @@ class Jailor(Citizen):
 
                 return False
 
-            await game.ctx.bot.wait_for("message", check=check)
+            await game.ctx.bot.wait_for_message(
+                player.channel, target.channel, check=check
+            )
 
 
 class PI(Citizen):
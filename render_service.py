@@ -0,0 +1,26 @@
+"""Runs the render workers on their own, so that every bot process on the host can
+share them. Set render_socket in the config of the bots that should use it"""
+import asyncio
+import multiprocessing
+import os
+
+import config
+from utils.imaging import RenderPool, RenderService
+
+
+async def main():
+    pool = RenderPool(
+        getattr(config, "render_workers", None) or os.cpu_count() or 1,
+        getattr(config, "render_queue_depth", 4),
+    )
+    try:
+        await RenderService(pool).serve(config.render_socket)
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("forkserver")
+    # PIL and numpy get imported once in the forkserver instead of in every worker
+    multiprocessing.set_forkserver_preload(["utils.rendering"])
+    asyncio.run(main())
@@ -1,6 +1,16 @@
 from .misc import *
 from .custom_cog import Cog
 from .custom_context import Context
+from .dispatch import MessageDispatcher
 from .custom_bot import MafiaBot
-from .imaging import create_day_image, create_night_image, cleanup_game
+from .imaging import (
+    create_day_image,
+    create_night_image,
+    cleanup_game,
+    discard_avatar,
+    image_filename,
+    prefetch_avatar,
+    RenderFailed,
+    send_image,
+)
 from .menu import MafiaMenu, MafiaPages
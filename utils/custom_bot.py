@@ -5,7 +5,7 @@ import discord
 from discord.ext import commands
 
 import config
-from utils import Context
+from utils import Context, MessageDispatcher
 
 
 class MafiaBot(commands.Bot):
@@ -19,6 +19,25 @@ class MafiaBot(commands.Bot):
             ),
         )
         self.db: typing.Optional[asyncpg.pool.Pool] = None
+        self.messages = MessageDispatcher()
+
+    def dispatch(self, event_name: str, *args, **kwargs):
+        if event_name == "message":
+            self.messages.dispatch(*args)
+        super().dispatch(event_name, *args, **kwargs)
+
+    async def wait_for_message(
+        self,
+        *channels: discord.abc.Snowflake,
+        check: typing.Callable[[discord.Message], bool] = None,
+        author: discord.abc.Snowflake = None,
+        timeout: float = None,
+    ) -> discord.Message:
+        """Like wait_for("message"), but only messages sent in one of the channels
+        (and by author, if given) are ever checked"""
+        return await self.messages.wait_for(
+            *channels, check=check, author=author, timeout=timeout
+        )
 
     async def get_context(self, message, *, cls=Context):
         return await super().get_context(message, cls=cls)
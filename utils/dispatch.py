@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import typing
+
+import discord
+
+Check = typing.Callable[[discord.Message], bool]
+# The channel a waiter is listening in, and who it's listening to (None for anyone)
+_Key = typing.Tuple[int, typing.Optional[int]]
+
+
+class MessageDispatcher:
+    """Routes each message to only the waiters listening in the channel it was sent
+    in, rather than running every check the bot is waiting on like wait_for does.
+    Waiters are forgotten as soon as they're done, time out or get cancelled, so
+    nothing lingers once the phase that was waiting is over"""
+
+    def __init__(self):
+        self._waiters: typing.Dict[
+            _Key, typing.List[typing.Tuple[asyncio.Future, typing.Optional[Check]]]
+        ] = collections.defaultdict(list)
+
+    async def wait_for(
+        self,
+        *channels: discord.abc.Snowflake,
+        check: typing.Optional[Check] = None,
+        author: typing.Optional[discord.abc.Snowflake] = None,
+        timeout: typing.Optional[float] = None,
+    ) -> discord.Message:
+        """Waits for a message in any of the channels, optionally only from author,
+        that passes the check. Raises asyncio.TimeoutError the same as wait_for"""
+        future = asyncio.get_running_loop().create_future()
+        waiter = (future, check)
+        keys = [(channel.id, author.id if author else None) for channel in channels]
+        for key in keys:
+            self._waiters[key].append(waiter)
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            for key in keys:
+                waiters = self._waiters[key]
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiters[key]
+
+    def dispatch(self, message: discord.Message):
+        channel = message.channel.id
+        for key in ((channel, message.author.id), (channel, None)):
+            # copied, as a check may start waiting for something else
+            for future, check in list(self._waiters.get(key, ())):
+                if future.done():
+                    continue
+                try:
+                    if check is None or check(message):
+                        future.set_result(message)
+                except Exception as e:
+                    future.set_exception(e)
@@ -1,100 +1,1223 @@
 from __future__ import annotations
 
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
 import io
+import itertools
 import multiprocessing
+import os
+import pickle
+import socket
+import struct
+import threading
+import time
 import typing
-from concurrent.futures import ThreadPoolExecutor
+import urllib.parse
+import uuid
+import weakref
+from multiprocessing.connection import Connection
 
+import aiohttp
 import discord
-from PIL import Image, ImageDraw, ImageFont
+
+import config
 
 if typing.TYPE_CHECKING:
     from mafia import MafiaGame, Player
 
-alpha = None
-# fonts in
-font_28days_title = ImageFont.truetype("./resources/28 Days Later.ttf", size=256)
-font_28days = ImageFont.truetype("./resources/28 Days Later.ttf", size=64)
-font_vermillion = ImageFont.truetype("./resources/Vermillion.ttf", size=34)
+# How rendered images are encoded before they're uploaded
+OUTPUT_FORMAT = getattr(config, "render_format", "png").lower()  # png, webp or jpeg
+OUTPUT_PNG_COMPRESS_LEVEL = getattr(config, "render_png_compress_level", 6)
+OUTPUT_QUALITY = getattr(config, "render_quality", 85)  # for webp/jpeg
+OUTPUT_MIN_QUALITY = 20  # as low as the quality goes to fit render_max_bytes
+# If set, lossy images have their quality lowered until they fit in this many bytes
+OUTPUT_MAX_BYTES = getattr(config, "render_max_bytes", None)
+if OUTPUT_FORMAT not in ("png", "webp", "jpeg"):
+    # caught here rather than by every render in the workers
+    raise ValueError(
+        f"render_format should be png, webp or jpeg, not {OUTPUT_FORMAT!r}"
+    )
 
-death_marker = Image.open("./resources/death-marker.png", formats=("png",)).resize(
-    (96, 96)
-)
+# How long a worker has to finish a job before it's assumed to be stuck and restarted
+RENDER_TIMEOUT = getattr(config, "render_timeout", 30)
+# Where the workers run. "process" gives each worker its own process, "thread" runs
+# them in threads of the bot's process, which is plenty for small deployments as PIL
+# lets go of the GIL while it resizes and encodes. "auto" only uses threads when
+# there are too few cores for worker processes to be worth it
+RENDER_BACKEND = getattr(config, "render_backend", "auto")
+THREAD_BACKEND_MAX_CPUS = 2
 
-processes: typing.Dict[int, "GameProcessor"] = {}
-pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ImageWaiter-")
+# The sizes day images are sent at. Under load, renders drop down a tier at a time
+# to keep up, and come back up once it's passed
+RENDER_TIERS = [(1920, 1080), (1280, 720), (960, 540)]
+ADAPTIVE_RENDER = getattr(config, "render_adaptive", True)
+# Drop a tier once this many jobs are queued up or in flight...
+TIER_QUEUE_DEPTH = getattr(config, "render_tier_queue_depth", 8)
+# ...or once recent jobs take longer than this many seconds to come back
+TIER_LATENCY = getattr(config, "render_tier_latency", 3)
+TIER_COOLDOWN = 10  # seconds between tier changes, so it doesn't flip back and forth
 
+OP_NIGHT = 0  # render the night image
+OP_DAY = 1  # render the day image for a game
+OP_REGISTER = 2  # initial game dump, with the avatars
+OP_DROP = 3  # the game is over, forget about it
+OP_AVATARS = 4  # avatars sent ahead of the game, while people are joining
 
-async def create_day_image(game: MafiaGame, deaths: typing.List[Player]) -> io.BytesIO:
-    if id(game) not in processes:
-        # make a new renderer
-        parent, child = multiprocessing.Pipe(True)
-        processes[id(game)] = proc = GameProcessor(args=(child,))
-        proc.start()
-        proc.pipe = parent
-        parent.send({"g": await serialize_game(game, include_avatars=True)})
-        parent.send({"op": 1, "g": {}, "d": [x.member.id for x in deaths]})
+# Every request starts with the protocol version, its opcode and the job it's for.
+# Responses start with the version, the job, what kind of result follows, and how
+# many microseconds the worker spent on the job and on encoding the image
+PROTOCOL_VERSION = 6
+_REQUEST = struct.Struct("!BBI")
+_RESPONSE = struct.Struct("!BIBII")
+_NIGHT = struct.Struct("!H")  # the night number
+_DAY = struct.Struct("!16sHBBB")  # game handle, day, amount of deaths and changes, tier
+_DEATH = struct.Struct("!Q")  # the id of someone who died last night
+_CHANGE = struct.Struct("!BBB")  # player index, PLAYER_ flags, role length (0 if same)
+
+PLAYER_DEAD = 1
+PLAYER_CLEANED = 2
+
+RESULT_NONE = 0
+RESULT_IMAGE = 1  # the encoded image follows
+RESULT_ERROR = 2  # a pickled exception follows
+
+Change = typing.Tuple[int, int, typing.Optional[str]]
+
+
+def encode_request(op: int, job: int, body: bytes) -> bytes:
+    return _REQUEST.pack(PROTOCOL_VERSION, op, job) + body
+
+
+def encode_day(
+    handle: str,
+    day: int,
+    deaths: typing.List[int],
+    changes: typing.List[Change],
+    tier: int = 0,
+) -> bytes:
+    parts = [_DAY.pack(bytes.fromhex(handle), day, len(deaths), len(changes), tier)]
+    parts.extend(_DEATH.pack(d) for d in deaths)
+    for index, flags, role in changes:
+        role = role.encode() if role is not None else b""
+        parts.append(_CHANGE.pack(index, flags, len(role)) + role)
+
+    return b"".join(parts)
+
+
+def decode_day(
+    body: memoryview,
+) -> typing.Tuple[str, int, typing.List[int], typing.List[Change], int]:
+    handle, day, amount_deaths, amount_changes, tier = _DAY.unpack_from(body)
+    offset = _DAY.size
+    deaths = []
+    for _ in range(amount_deaths):
+        deaths.append(_DEATH.unpack_from(body, offset)[0])
+        offset += _DEATH.size
 
+    changes = []
+    for _ in range(amount_changes):
+        index, flags, length = _CHANGE.unpack_from(body, offset)
+        offset += _CHANGE.size
+        role = bytes(body[offset : offset + length]).decode() if length else None
+        offset += length
+        changes.append((index, flags, role))
+
+    return handle.hex(), day, deaths, changes, tier
+
+
+def encode_response(
+    job: int, result: typing.Any, busy: float = 0, encode: float = 0
+) -> bytes:
+    if result is None:
+        status, body = RESULT_NONE, b""
+    elif isinstance(result, BaseException):
+        status, body = RESULT_ERROR, pickle.dumps(result)
     else:
-        proc = processes[id(game)]
-        proc.pipe.send(
-            {
-                "op": 1,
-                "d": [x.member.id for x in deaths],
-                "g": await serialize_game(game, include_avatars=False),
+        status, body = RESULT_IMAGE, result.getbuffer()
+
+    timings = int(busy * 1_000_000), int(encode * 1_000_000)
+    return _RESPONSE.pack(PROTOCOL_VERSION, job, status, *timings) + body
+
+
+def decode_response(
+    frame: bytes,
+) -> typing.Tuple[int, typing.Any, typing.Tuple[float, float]]:
+    """Returns the job, its result, and how long the worker spent on it and on
+    encoding, in seconds"""
+    _, job, status, busy, encode = _RESPONSE.unpack_from(frame)
+    timings = busy / 1_000_000, encode / 1_000_000
+    body = memoryview(frame)[_RESPONSE.size :]
+    if status == RESULT_IMAGE:
+        return job, io.BytesIO(body), timings
+    elif status == RESULT_ERROR:
+        return job, pickle.loads(body), timings
+    return job, None, timings
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> bytes:
+    """Reads one message in the same framing multiprocessing's Connection uses"""
+    (size,) = struct.unpack("!i", await reader.readexactly(4))
+    if size == -1:
+        (size,) = struct.unpack("!Q", await reader.readexactly(8))
+
+    return await reader.readexactly(size)
+
+
+def _write_frame(writer: asyncio.StreamWriter, payload: bytes):
+    writer.write(struct.pack("!i", len(payload)) + payload)
+
+
+class RenderFailed(Exception):
+    """The image couldn't be rendered, or it wasn't rendered in time"""
+
+
+class RenderStats:
+    """Counters and recent timings for the render pipeline, so the pool can be
+    sized from what it actually does"""
+
+    def __init__(self, samples: int):
+        self.started = time.time()
+        self.counters: typing.Counter[str] = collections.Counter()
+        # only the most recent timings are kept for each stage, in seconds
+        self.timings: typing.Dict[str, typing.Deque[float]] = collections.defaultdict(
+            lambda: collections.deque(maxlen=samples)
+        )
+
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] += amount
+
+    def record(self, stage: str, seconds: float):
+        self.timings[stage].append(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def dump(self, pool: RenderPool) -> dict:
+        """Everything as plain types, timings are in milliseconds"""
+        timings = {}
+        for stage, samples in self.timings.items():
+            ordered = sorted(samples)
+            timings[stage] = {
+                "samples": len(ordered),
+                "p50": ordered[len(ordered) // 2] * 1000,
+                "p95": ordered[min(len(ordered) - 1, len(ordered) * 95 // 100)] * 1000,
+                "max": ordered[-1] * 1000,
             }
+
+        return {
+            "uptime": time.time() - self.started,
+            "workers": {
+                "backend": "service" if pool.path is not None else pool.backend,
+                "size": pool.size,
+                "started": len(pool.workers),
+                "alive": sum(1 for w in pool.workers if w.alive),
+                "games": sum(len(w.games) for w in pool.workers),
+                "queued": sum(w.queued for w in pool.workers),
+                "in_flight": sum(len(w.pending) for w in pool.workers),
+            },
+            "tier": RENDER_TIERS[pool._tier],
+            "counters": dict(self.counters),
+            "timings": timings,
+        }
+
+
+render_stats = RenderStats(getattr(config, "render_stats_samples", 500))
+
+
+class BaseRenderWorker:
+    """What every kind of render worker keeps track of: the games pinned to it,
+    the jobs it's working on, and the ones waiting for it"""
+
+    process: typing.Optional[GameProcessor] = None
+
+    def __init__(self, max_pending: typing.Optional[int]):
+        # The games pinned to this worker, and the task that registers them
+        self.games: typing.Dict[str, asyncio.Task] = {}
+        # Jobs sent to the worker that are waiting for their result
+        self.pending: typing.Dict[int, asyncio.Future] = {}
+        self._jobs = itertools.count()
+        # Once this many jobs are waiting on the worker, anything else waits here.
+        # Without a limit, whatever's on the other end decides how much it takes on
+        self._slots = asyncio.Semaphore(max_pending) if max_pending else None
+        self.queued = 0  # jobs waiting for a slot
+        self.closed = False
+
+    @contextlib.asynccontextmanager
+    async def _slot(self):
+        if self._slots is None:
+            render_stats.count("jobs_submitted")
+            yield
+            return
+
+        self.queued += 1
+        render_stats.count("jobs_submitted")
+        try:
+            with render_stats.timed("queue_wait"):
+                await self._slots.acquire()
+        finally:
+            self.queued -= 1
+
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def _fail_pending(self):
+        for fut in self.pending.values():
+            if not fut.done():
+                render_stats.count("jobs_lost")
+                fut.set_exception(ConnectionError("Render worker exited"))
+        self.pending.clear()
+
+    @property
+    def alive(self) -> bool:
+        return not self.closed
+
+    async def request(
+        self, op: int, body: typing.Union[bytes, typing.Callable[[], bytes]]
+    ) -> typing.Tuple[typing.Any, typing.Tuple[float, float]]:
+        """Sends a job to the worker and waits for its result, as it was sent back,
+        along with the worker's timings. The body can be a function, in which case
+        it's only built right before it's sent"""
+        raise NotImplementedError
+
+    async def submit(
+        self, op: int, body: typing.Union[bytes, typing.Callable[[], bytes]]
+    ) -> typing.Any:
+        """Sends a job to the worker and returns the result, raising any error the
+        worker sent back"""
+        result, _ = await self.request(op, body)
+        if isinstance(result, BaseException):
+            render_stats.count("jobs_failed")
+            if isinstance(result, ConnectionError):
+                # the render service lost the game, it needs sending again
+                self.close()
+            raise result
+        render_stats.count("jobs_completed")
+        if result is not None:
+            render_stats.count("bytes_produced", result.getbuffer().nbytes)
+        return result
+
+    def close(self):
+        self.closed = True
+        self._fail_pending()
+
+
+class RenderWorker(BaseRenderWorker):
+    """A single render process, along with the games that are pinned to it.
+    A game's avatars live in the worker that it was first assigned to. Given the
+    path of a render service's socket, it's a connection to that instead"""
+
+    def __init__(
+        self, max_pending: typing.Optional[int], path: typing.Optional[str] = None
+    ):
+        super().__init__(max_pending)
+        if path is None:
+            parent, child = socket.socketpair()
+            child = Connection(child.detach())
+            self.process = GameProcessor(args=(child,), daemon=True)
+            self.process.start()
+            child.close()
+            connect = asyncio.open_connection(sock=parent)
+        else:
+            connect = asyncio.open_unix_connection(path)
+        self._connected = asyncio.create_task(connect)
+        self._reader_task = asyncio.create_task(self._read_responses())
+
+    async def _read_responses(self):
+        try:
+            reader, _ = await self._connected
+            while True:
+                job, result, timings = decode_response(await _read_frame(reader))
+                render_stats.record("worker_busy", timings[0])
+                if timings[1]:
+                    render_stats.record("encode", timings[1])
+                fut = self.pending.pop(job, None)
+                if fut is not None and not fut.done():
+                    fut.set_result((result, timings))
+        except (asyncio.IncompleteReadError, OSError):
+            # the worker went away, don't leave anyone waiting forever
+            self._fail_pending()
+
+    @property
+    def alive(self) -> bool:
+        # is_alive checks the process' sentinel, so this catches it dying before
+        # the reader has noticed the socket closing
+        return (
+            super().alive
+            and not self._reader_task.done()
+            and (self.process is None or self.process.is_alive())
+        )
+
+    async def request(
+        self, op: int, body: typing.Union[bytes, typing.Callable[[], bytes]]
+    ) -> typing.Tuple[typing.Any, typing.Tuple[float, float]]:
+        async with self._slot():
+            _, writer = await self._connected
+            if not self.alive:
+                raise ConnectionError("Render worker exited")
+
+            job = next(self._jobs)
+            fut = self.pending[job] = asyncio.get_running_loop().create_future()
+            try:
+                _write_frame(
+                    writer,
+                    encode_request(
+                        op, job, body if isinstance(body, bytes) else body()
+                    ),
+                )
+                await writer.drain()
+                with render_stats.timed("round_trip"):
+                    result = await asyncio.wait_for(fut, RENDER_TIMEOUT)
+            except asyncio.TimeoutError:
+                # it's stuck, and so is everything queued up behind this job
+                render_stats.count("jobs_timed_out")
+                if self.process is not None:
+                    self.process.kill()
+                self.close()
+                raise
+            except ConnectionError:
+                # the connection broke while we were writing, it isn't coming back
+                self.pending.pop(job, None)
+                self.close()
+                raise
+            finally:
+                self.pending.pop(job, None)
+
+        return result
+
+    def close(self):
+        super().close()
+        if self.process is not None:
+            self.process.terminate()
+        self._reader_task.cancel()
+        if self._connected.done() and not self._connected.cancelled():
+            _, writer = self._connected.result()
+            writer.close()
+
+
+class ThreadRenderWorker(BaseRenderWorker):
+    """A render worker that's a thread in the bot's own process. It keeps the same
+    state a worker process would, and runs its jobs one at a time the same way, so
+    the pool can't tell the difference"""
+
+    # the fonts and backgrounds are shared by every worker, only one loads them
+    _preload = threading.Lock()
+
+    def __init__(self, max_pending: int):
+        from utils import rendering
+
+        super().__init__(max_pending)
+        # what's been handed to the thread, so anything it hasn't started on yet
+        # can be called off when the worker's closed
+        self._work: typing.Dict[int, concurrent.futures.Future] = {}
+        self._rendering = rendering
+        self._state = rendering.RenderState()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="render"
         )
+        self._executor.submit(self._load)
+
+    def _load(self):
+        with self._preload:
+            self._rendering.preload()
+
+    def _handle(
+        self, op: int, body: bytes
+    ) -> typing.Tuple[typing.Any, typing.Tuple[float, float]]:
+        self._rendering.job_timings.encode = 0
+        start = time.perf_counter()
+        try:
+            result = self._state.handle(op, memoryview(body))
+        except Exception as e:
+            result = e
+
+        busy = time.perf_counter() - start
+        return result, (busy, self._rendering.job_timings.encode)
+
+    @staticmethod
+    def _finished(fut: asyncio.Future, work: concurrent.futures.Future):
+        # the job may have already been given up on
+        if fut.done() or work.cancelled():
+            return
+        if work.exception() is not None:
+            fut.set_exception(work.exception())
+        else:
+            fut.set_result(work.result())
+
+    async def request(
+        self, op: int, body: typing.Union[bytes, typing.Callable[[], bytes]]
+    ) -> typing.Tuple[typing.Any, typing.Tuple[float, float]]:
+        async with self._slot():
+            if not self.alive:
+                raise ConnectionError("Render worker exited")
+
+            loop = asyncio.get_running_loop()
+            job = next(self._jobs)
+            fut = self.pending[job] = loop.create_future()
+            work = self._work[job] = self._executor.submit(
+                self._handle, op, body if isinstance(body, bytes) else body()
+            )
+            work.add_done_callback(
+                lambda _: loop.call_soon_threadsafe(self._finished, fut, work)
+            )
+            try:
+                with render_stats.timed("round_trip"):
+                    result, timings = await asyncio.wait_for(fut, RENDER_TIMEOUT)
+            except asyncio.TimeoutError:
+                # a thread can't be killed, it's left to finish whatever it's stuck
+                # on while its games move over to a fresh worker
+                render_stats.count("jobs_timed_out")
+                self.close()
+                raise
+            finally:
+                self.pending.pop(job, None)
+                self._work.pop(job, None)
+
+        render_stats.record("worker_busy", timings[0])
+        if timings[1]:
+            render_stats.record("encode", timings[1])
+        return result, timings
+
+    def close(self):
+        super().close()
+        for work in self._work.values():
+            work.cancel()  # only does anything for jobs that haven't started
+        self._executor.shutdown(wait=False)
+
+
+class RenderPool:
+    """A fixed size pool of render processes shared by every game. Workers are
+    started as they're needed, up to the size of the pool, after which new games
+    are pinned to the worker with the least amount of games. With a path, the
+    workers belong to a render service instead and this only connects to it. The
+    thread backend has the workers be threads instead of processes"""
 
-    return await game.ctx.bot.loop.run_in_executor(pool, proc.pipe.recv)
+    def __init__(
+        self,
+        size: int,
+        max_pending: typing.Optional[int],
+        path: typing.Optional[str] = None,
+        backend: str = "process",
+    ):
+        self.size = size
+        self.max_pending = max_pending
+        self.path = path
+        self.backend = backend
+        self.workers: typing.List[BaseRenderWorker] = []
+        self.assignments: typing.Dict[str, BaseRenderWorker] = {}
+        # What each game's players looked like the last time the worker was told
+        self._sent: typing.Dict[str, typing.List[typing.Tuple[int, str]]] = {}
+        # The latest day image asked for by each game, along with what it was for
+        self._days: typing.Dict[str, typing.Tuple[tuple, asyncio.Task]] = {}
+        self._tier = 0
+        self._tier_changed = 0.0
+        # Avatars being sent ahead for games that haven't started yet, by user id.
+        # Each task returns the worker it sent the avatar to, or None if no worker
+        # needs to be sent it
+        self._prefetches: typing.Dict[
+            str, typing.Dict[int, asyncio.Task]
+        ] = collections.defaultdict(dict)
+
+    def _respawn(self):
+        """Replaces any workers that have died. The games that were pinned to them
+        move over to the replacement, and are sent to it again straight away"""
+        games = {handle: game for game, handle in _handles.items()}
+        for index, worker in enumerate(self.workers):
+            if worker.alive:
+                continue
+
+            worker.close()
+            render_stats.count("worker_respawns")
+            replacement = self.workers[index] = self._new_worker()
+            for handle, assigned in list(self.assignments.items()):
+                if assigned is not worker:
+                    continue
+                if handle not in games:
+                    # the game's gone, it just never got cleaned up
+                    del self.assignments[handle]
+                    continue
+                self.assignments[handle] = replacement
+                replacement.games[handle] = asyncio.create_task(
+                    self._register(games[handle], replacement)
+                )
+
+    def _new_worker(self) -> BaseRenderWorker:
+        if self.backend == "thread":
+            return ThreadRenderWorker(self.max_pending)
+        return RenderWorker(self.max_pending, self.path)
+
+    def _least_loaded(
+        self, load: typing.Callable[[BaseRenderWorker], int]
+    ) -> BaseRenderWorker:
+        self._respawn()
+        # only start up another worker if all of the current ones have something to do
+        if len(self.workers) < self.size and all(load(w) for w in self.workers):
+            self.workers.append(self._new_worker())
+
+        return min(self.workers, key=load)
+
+    def worker_for(self, handle: str) -> BaseRenderWorker:
+        worker = self.assignments.get(handle)
+        if worker is not None and not worker.alive:
+            self._respawn()
+            worker = self.assignments.get(handle)
+        if worker is None:
+            worker = self._least_loaded(lambda w: len(w.games))
+            self.assignments[handle] = worker
+
+        return worker
+
+    async def _registered_worker(self, game: MafiaGame) -> BaseRenderWorker:
+        handle = game_handle(game)
+        worker = self.worker_for(handle)
+
+        if handle not in worker.games:
+            # the first job for this game needs to send the avatars over first
+            worker.games[handle] = asyncio.create_task(self._register(game, worker))
+        registration = worker.games[handle]
+        try:
+            await asyncio.shield(registration)
+        except Exception:
+            # try sending the game over again next time
+            if worker.games.get(handle) is registration:
+                del worker.games[handle]
+            raise
+
+        return worker
+
+    def prefetch_avatar(self, game: MafiaGame, member: discord.Member):
+        """Starts getting someone's avatar to the game's worker as soon as they join,
+        so it doesn't have to happen once the game starts"""
+        tasks = self._prefetches[game_handle(game)]
+        if member.id not in tasks:
+            tasks[member.id] = asyncio.create_task(self._prefetch(game, member))
+
+    def discard_avatar(self, game: MafiaGame, user_id: int):
+        """They left before the game started. If their avatar already made it to the
+        worker, it's thrown away when the game is registered"""
+        task = self._prefetches[game_handle(game)].pop(user_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def _prefetch(
+        self, game: MafiaGame, member: discord.Member
+    ) -> typing.Optional[BaseRenderWorker]:
+        handle = game_handle(game)
+        key = AvatarCache.key(member)
+        if avatar_cache is not None and key in avatar_cache:
+            return None  # the worker will load it from the cache anyway
+        data = await fetch_avatar(member)
+        if data is None:
+            return None  # no use trying again, they get the placeholder
+
+        worker = self.worker_for(handle)
+        body = bytes.fromhex(handle) + pickle.dumps({member.id: (key, data)})
+        await worker.submit(OP_AVATARS, body)
+        return worker
+
+    async def _prefetched(
+        self, handle: str, worker: BaseRenderWorker
+    ) -> typing.Set[int]:
+        """The users whose avatars don't need sending with the game, because the
+        worker already has them or there was no getting them"""
+        tasks = self._prefetches.pop(handle, {})
+        # any still going are part way there already, it's quicker to let them finish
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        return {
+            uid
+            for uid, result in zip(tasks, results)
+            if result is None or result is worker
+        }
+
+    async def _register(self, game: MafiaGame, worker: BaseRenderWorker):
+        handle = game_handle(game)
+        with render_stats.timed("avatar_fetch"):
+            prefetched = await self._prefetched(handle, worker)
+            data = await serialize_game(game, True, prefetched)
+        # remember exactly what the worker was sent, so later changes are caught
+        self._sent[handle] = [
+            ((PLAYER_DEAD if p["d"] else 0) | (PLAYER_CLEANED if p["c"] else 0), p["r"])
+            for p in data["p"]
+        ]
+        await worker.submit(OP_REGISTER, bytes.fromhex(handle) + pickle.dumps(data))
+
+    def _changes(self, game: MafiaGame) -> typing.List[Change]:
+        """The players that changed since the worker was last told about them"""
+        sent = self._sent[game_handle(game)]
+        changes = []
+        for index, player in enumerate(game.players):
+            flags, role = state = _player_state(player)
+            if state != sent[index]:
+                changes.append((index, flags, role if role != sent[index][1] else None))
+                sent[index] = state
+
+        return changes
+
+    def tier(self) -> int:
+        """The tier day images should be rendered at, given how busy we are"""
+        if not ADAPTIVE_RENDER:
+            return 0
+
+        now = time.monotonic()
+        if now - self._tier_changed < TIER_COOLDOWN:
+            return self._tier
+
+        load = sum(w.queued + len(w.pending) for w in self.workers)
+        recent = list(render_stats.timings["round_trip"])[-5:]
+        latency = sorted(recent)[len(recent) // 2] if recent else 0
+        if load >= TIER_QUEUE_DEPTH or latency >= TIER_LATENCY:
+            if self._tier < len(RENDER_TIERS) - 1:
+                self._tier += 1
+                self._tier_changed = now
+                render_stats.count("tier_drops")
+        elif load < TIER_QUEUE_DEPTH / 2 and (not load or latency < TIER_LATENCY / 2):
+            # nothing being rendered means the old latencies don't mean much anymore
+            if self._tier:
+                self._tier -= 1
+                self._tier_changed = now
+
+        return self._tier
+
+    async def _run(
+        self, name: str, job: typing.Callable[[], typing.Awaitable[io.BytesIO]]
+    ) -> io.BytesIO:
+        """Runs a job, trying once more on a fresh worker if the worker it was sent
+        to died. A job that runs out of time isn't tried again"""
+        try:
+            with render_stats.timed(name):
+                for attempt in range(2):
+                    try:
+                        return await job()
+                    except ConnectionError as e:
+                        if attempt:
+                            raise RenderFailed("Render worker exited") from e
+                    except asyncio.TimeoutError as e:
+                        raise RenderFailed("Render timed out") from e
+                    except Exception as e:
+                        raise RenderFailed(str(e)) from e
+        except RenderFailed:
+            render_stats.count(f"{name}_failed")
+            raise
+
+    async def render_day(self, game: MafiaGame, deaths: typing.List[int]) -> io.BytesIO:
+        """Renders the day image. Asking for the same image again while it's being
+        rendered, or after, waits on or reuses that render instead of doing another"""
+        handle = game_handle(game)
+        key = (
+            game._day,
+            tuple(deaths),
+            tuple(map(_player_state, game.players)),
+        )  # noqa
+        latest = self._days.get(handle)
+        if latest is not None and latest[0] == key:
+            task = latest[1]
+            # a failed render isn't kept around, the next request tries again
+            if not task.done() or task.exception() is None:
+                render_stats.count("day_coalesced")
+                return io.BytesIO(await asyncio.shield(task))
+
+        # only the latest day is kept, once anything changes the old one is useless
+        task = asyncio.create_task(self._render_day(game, deaths))
+        self._days[handle] = key, task
+        return io.BytesIO(await asyncio.shield(task))
+
+    async def _render_day(self, game: MafiaGame, deaths: typing.List[int]) -> bytes:
+        async def job():
+            worker = await self._registered_worker(game)
+            return await worker.submit(
+                OP_DAY,
+                lambda: encode_day(
+                    game_handle(game),
+                    game._day,  # noqa
+                    deaths,
+                    self._changes(game),
+                    self.tier(),
+                ),
+            )
+
+        buf = await self._run("day", job)
+        data = buf.getvalue()
+        buf.close()
+        return data
+
+    async def render_night(self, night: int) -> io.BytesIO:
+        """Night images don't rely on any game state, so they go to whichever worker
+        is the least busy"""
+
+        async def job():
+            worker = self._least_loaded(lambda w: len(w.pending))
+            return await worker.submit(OP_NIGHT, _NIGHT.pack(night))
+
+        return await self._run("night", job)
+
+    async def drop(self, game: MafiaGame):
+        handle = _handles.pop(game, None)
+        worker = self.assignments.pop(handle, None)
+        self._sent.pop(handle, None)
+        self._days.pop(handle, None)
+        for task in self._prefetches.pop(handle, {}).values():
+            task.cancel()
+        if worker is not None:
+            worker.games.pop(handle, None)
+            # if the worker died, the game went with it anyway
+            with contextlib.suppress(ConnectionError, asyncio.TimeoutError):
+                await worker.submit(OP_DROP, bytes.fromhex(handle))
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers.clear()
+        self.assignments.clear()
+
+
+class RenderService:
+    """Shares one pool of render workers between every bot process on the host.
+    Bots connect over a unix socket and speak the same protocol as the workers do,
+    jobs are passed on to the worker their game is pinned to"""
+
+    def __init__(self, pool: RenderPool):
+        self.pool = pool
+        # the connection each game was registered over. A bot that reconnects
+        # registers its games again, so this is whoever registered it last
+        self.owners: typing.Dict[str, asyncio.StreamWriter] = {}
+
+    async def serve(self, path: str):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)  # left behind by a service that didn't shut down cleanly
+
+        server = await asyncio.start_unix_server(self._client, path)
+        async with server:
+            await server.serve_forever()
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        jobs = set()
+        try:
+            while True:
+                frame = await _read_frame(reader)
+                # jobs are answered in whatever order they finish, same as a worker
+                job = asyncio.create_task(self._job(memoryview(frame), writer))
+                jobs.add(job)
+                job.add_done_callback(jobs.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for job in jobs:
+                job.cancel()
+            writer.close()
+            # the bot's gone, nobody is going to drop its games
+            for handle, owner in list(self.owners.items()):
+                if owner is writer:
+                    await self._drop(handle)
+
+    async def _job(self, frame: memoryview, writer: asyncio.StreamWriter):
+        version, op, job = _REQUEST.unpack_from(frame)
+        body = frame[_REQUEST.size :]
+        result, timings = None, (0, 0)
+        try:
+            if version != PROTOCOL_VERSION:
+                raise RuntimeError(f"unsupported protocol version {version}")
+
+            if op == OP_NIGHT:
+                worker = self.pool._least_loaded(lambda w: len(w.pending))
+                result, timings = await worker.request(op, bytes(body))
+            elif op == OP_DROP:
+                await self._drop(bytes(body[:16]).hex())
+            else:
+                handle = bytes(body[:16]).hex()
+                if op == OP_AVATARS:
+                    self.owners[handle] = writer
+                    worker = self.pool.worker_for(handle)
+                    result, timings = await worker.request(op, bytes(body))
+                elif op == OP_REGISTER:
+                    self.owners[handle] = writer
+                    worker = self.pool.worker_for(handle)
+                    task = worker.games[handle] = asyncio.ensure_future(
+                        worker.request(op, bytes(body))
+                    )
+                    result, timings = await task
+                else:
+                    worker = self.pool.assignments.get(handle)
+                    if worker is None or not worker.alive:
+                        # the worker it was on died, the bot needs to send it again
+                        raise ConnectionError("Render worker exited")
+                    result, timings = await worker.request(op, bytes(body))
+        except Exception as e:
+            result = e
+
+        _write_frame(writer, encode_response(job, result, *timings))
+        with contextlib.suppress(ConnectionError):
+            await writer.drain()
+        if isinstance(result, ConnectionError):
+            # the only way to get the bot to register its games again
+            writer.close()
+
+    async def _drop(self, handle: str):
+        self.owners.pop(handle, None)
+        worker = self.pool.assignments.pop(handle, None)
+        if worker is not None:
+            worker.games.pop(handle, None)
+            with contextlib.suppress(ConnectionError, asyncio.TimeoutError):
+                await worker.request(OP_DROP, bytes.fromhex(handle))
+
+
+# The socket of a render service to use instead of starting our own workers
+RENDER_SOCKET = getattr(config, "render_socket", None)
+if RENDER_SOCKET is not None:
+    # the service spreads the games over its own workers, one connection is enough.
+    # Its workers each have their own queue, so this one doesn't hold anything back
+    render_pool = RenderPool(1, None, RENDER_SOCKET)
+else:
+    if RENDER_BACKEND == "auto":
+        cpus = os.cpu_count() or 1
+        RENDER_BACKEND = "thread" if cpus <= THREAD_BACKEND_MAX_CPUS else "process"
+    render_pool = RenderPool(
+        getattr(config, "render_workers", None) or os.cpu_count() or 1,
+        getattr(config, "render_queue_depth", 4),
+        backend=RENDER_BACKEND,
+    )
+# A stable handle for each game, used to find their state in the render workers
+_handles: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def game_handle(game: MafiaGame) -> str:
+    if game not in _handles:
+        _handles[game] = uuid.uuid4().hex
+
+    return _handles[game]
+
+
+def _player_state(p: Player) -> typing.Tuple[int, str]:
+    # everything about a player that can change during a game and shows in an image
+    flags = (PLAYER_DEAD if p.dead else 0) | (PLAYER_CLEANED if p.role.cleaned else 0)
+    return flags, str(p.role)
+
+
+async def create_day_image(game: MafiaGame, deaths: typing.List[Player]) -> io.BytesIO:
+    return await render_pool.render_day(game, [x.member.id for x in deaths])
+
+
+class ImageCache:
+    """A LRU cache of encoded images that are the same no matter the game they're
+    for, optionally persisted to disk so they survive restarts"""
+
+    def __init__(self, max_size: int, directory: typing.Optional[str] = None):
+        self.max_size = max_size
+        self.directory = directory
+        self._images: typing.OrderedDict[str, bytes] = collections.OrderedDict()
+        # renders that are currently happening, so other games can wait on them
+        self._pending: typing.Dict[str, asyncio.Task] = {}
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        # images encoded with different settings are never mixed up
+        return os.path.join(self.directory, image_filename(f"{key}-{encoding_id()}"))
+
+    def _read(self, key: str) -> typing.Optional[bytes]:
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key: str, data: bytes):
+        with open(self._path(key), "wb") as f:
+            f.write(data)
+
+    def _remember(self, key: str, data: bytes):
+        self._images[key] = data
+        self._images.move_to_end(key)
+        while len(self._images) > self.max_size:
+            self._images.popitem(last=False)
+
+    async def get(
+        self, key: str, render: typing.Callable[[], typing.Awaitable[io.BytesIO]]
+    ) -> io.BytesIO:
+        """Returns the cached image for this key, calling render if we don't have it"""
+        if key in self._images:
+            render_stats.count("image_cache_hits")
+            self._images.move_to_end(key)
+            return io.BytesIO(self._images[key])
+
+        render_stats.count("image_cache_misses")
+        if key not in self._pending:
+            self._pending[key] = asyncio.create_task(self._fetch(key, render))
+        return io.BytesIO(await asyncio.shield(self._pending[key]))
+
+    async def _fetch(
+        self, key: str, render: typing.Callable[[], typing.Awaitable[io.BytesIO]]
+    ) -> bytes:
+        loop = asyncio.get_running_loop()
+        data = None
+        try:
+            if self.directory is not None:
+                data = await loop.run_in_executor(None, self._read, key)
+            if data is None:
+                buf = await render()
+                data = buf.getvalue()
+                buf.close()
+                if self.directory is not None:
+                    await loop.run_in_executor(None, self._write, key, data)
+        finally:
+            self._pending.pop(key, None)
+
+        self._remember(key, data)
+        return data
+
+
+night_images = ImageCache(
+    getattr(config, "night_cache_size", 32), getattr(config, "render_cache_dir", None)
+)
 
 
 async def create_night_image(game: MafiaGame) -> io.BytesIO:
-    if id(game) not in processes:
-        # make a new renderer
-        parent, child = multiprocessing.Pipe(True)
-        processes[id(game)] = proc = GameProcessor(args=(child,))
-        proc.start()
-        proc.pipe = parent
-        parent.send({"g": await serialize_game(game, include_avatars=True)})
-        parent.send({"op": 0, "d": game._day - 1})  # noqa
+    night = game._day - 1  # noqa
+    return await night_images.get(
+        f"night-{night}",
+        lambda: render_pool.render_night(night),
+    )
+
+
+def encoding_id() -> str:
+    """A short hash of every setting that changes how an image is encoded"""
+    settings = (
+        OUTPUT_FORMAT,
+        OUTPUT_PNG_COMPRESS_LEVEL,
+        OUTPUT_QUALITY,
+        OUTPUT_MIN_QUALITY,
+        OUTPUT_MAX_BYTES,
+    )
+    return hashlib.sha1(repr(settings).encode()).hexdigest()[:8]
+
+
+def image_filename(name: str) -> str:
+    """The filename to upload a rendered image as, matching the format it's in"""
+    return f"{name}.{'jpg' if OUTPUT_FORMAT == 'jpeg' else OUTPUT_FORMAT}"
+
+
+class AttachmentCache:
+    """Remembers where images we've already uploaded live on Discord's CDN, by
+    their content and where they can be reused, so sending the same image again
+    doesn't upload it again. The attachment goes away with the channel it was
+    sent in, so that's kept too"""
 
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._urls: typing.OrderedDict[
+            str, typing.Tuple[str, float, int]
+        ] = collections.OrderedDict()
+
+    @staticmethod
+    def key(data: bytes, scope: typing.Union[int, str]) -> str:
+        return f"{scope}-{hashlib.sha1(data).hexdigest()}"
+
+    def get(self, key: str) -> typing.Optional[str]:
+        if key not in self._urls:
+            return None
+
+        url, expires, _ = self._urls[key]
+        if time.time() >= expires:
+            del self._urls[key]
+            return None
+
+        self._urls.move_to_end(key)
+        return url
+
+    def store(self, key: str, url: str, channel_id: int):
+        # signed CDN urls say when they expire (in hex), give ourselves some leeway
+        expires = time.time() + self.ttl
+        ex = urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get("ex")
+        if ex:
+            with contextlib.suppress(ValueError):
+                expires = min(expires, int(ex[0], 16) - 3600)
+
+        self._urls[key] = url, expires, channel_id
+        self._urls.move_to_end(key)
+        while len(self._urls) > self.max_size:
+            self._urls.popitem(last=False)
+
+    def forget_channels(self, channel_ids: typing.Collection[int]):
+        """The channels are about to be deleted, and the attachments in them"""
+        for key, (_, _, channel_id) in list(self._urls.items()):
+            if channel_id in channel_ids:
+                del self._urls[key]
+
+
+attachments = AttachmentCache(
+    getattr(config, "attachment_cache_size", 256),
+    getattr(config, "attachment_cache_ttl", 86400),
+)
+# A channel that outlives every game, images are uploaded there once to be reused
+# by every game. Without one, an image is only reused in the channel it was sent in
+ATTACHMENT_CHANNEL_ID = getattr(config, "attachment_channel_id", None)
+
+
+async def _upload(
+    channel: discord.abc.Messageable, buf: io.BytesIO, name: str, key: str
+) -> discord.Message:
+    msg = await channel.send(file=discord.File(buf, filename=image_filename(name)))
+    if msg.attachments:
+        attachments.store(key, msg.attachments[0].url, msg.channel.id)
+    return msg
+
+
+async def send_image(
+    channel: discord.abc.Messageable,
+    buf: io.BytesIO,
+    name: str,
+    bot: typing.Optional[discord.Client] = None,
+) -> discord.Message:
+    """Sends an image, pointing an embed at where it was uploaded before if we
+    already sent this exact image somewhere it can be reused from. Given the bot,
+    that can be the attachment channel"""
+    data = buf.getvalue()
+    assets = None
+    if bot is not None and ATTACHMENT_CHANNEL_ID is not None:
+        assets = bot.get_channel(ATTACHMENT_CHANNEL_ID)
+
+    if assets is not None:
+        key = attachments.key(data, "assets")
+        url = attachments.get(key)
+        if url is None:
+            try:
+                await _upload(assets, buf, name, key)
+            except discord.HTTPException:
+                pass  # send it in the channel instead
+            buf.seek(0)
+            url = attachments.get(key)
     else:
-        proc = processes[id(game)]
-        proc.pipe.send({"op": 0, "d": game._day - 1})  # noqa
-
-    return await game.ctx.bot.loop.run_in_executor(pool, proc.pipe.recv)
-
-
-def add_corners(im, rad):
-    if im.size != (128, 128):
-        im = im.resize((128, 128))
-
-    global alpha
-    if not alpha:  # cache the alpha layer
-        circle = Image.new("L", (rad * 2, rad * 2), 0)
-        draw = ImageDraw.Draw(circle)
-        draw.ellipse((0, 0, rad * 2, rad * 2), fill=255)
-        alpha = Image.new("L", im.size, 255)
-        alpha.paste(circle.crop((0, 0, rad, rad)), (0, 0))
-        alpha.paste(circle.crop((0, rad, rad, rad * 2)), (0, im.size[0] - rad))
-        alpha.paste(circle.crop((rad, 0, rad * 2, rad)), (128 - rad, 0))
-        alpha.paste(
-            circle.crop((rad, rad, rad * 2, rad * 2)),
-            (im.size[0] - rad, im.size[0] - rad),
-        )
+        # the game's channels are deleted along with anything sent in them
+        key = attachments.key(data, channel.id)
+        url = attachments.get(key)
+
+    if url is not None:
+        try:
+            msg = await channel.send(embed=discord.Embed().set_image(url=url))
+        except discord.HTTPException:
+            pass  # upload it again instead
+        else:
+            render_stats.count("attachments_reused")
+            return msg
+
+    return await _upload(channel, buf, name, attachments.key(data, channel.id))
+
+
+class AvatarCache:
+    """Rounded avatars saved to disk, keyed by the user and their avatar hash so a
+    changed avatar is never served stale. The least recently used ones are removed
+    once the cache grows past max_bytes"""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # the size of the directory as of the last scan plus what's been stored
+        # since, so it's only scanned again once that goes over max_bytes. Other
+        # workers store into it too, which the next scan catches up on
+        self._total: typing.Optional[int] = None
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(member: discord.Member) -> str:
+        return f"{member.id}-{member.avatar or 'default'}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def load(self, key: str) -> typing.Optional[bytes]:
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
 
-    im.putalpha(alpha)
-    return im.resize((96, 96))  # resize it to a more respectable size
+        # the modified time is what keeps track of when it was last used
+        with contextlib.suppress(OSError):
+            os.utime(self._path(key))
+        return data
 
+    def store(self, key: str, data: bytes):
+        # write then rename, other workers may be reading this at the same time
+        tmp = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
 
-def round_avatar(avy: io.BytesIO, rad=64) -> Image:
-    return add_corners(Image.open(avy, formats=("png",)), rad)
+        if self._total is not None:
+            self._total += len(data)
+        if self._total is None or self._total > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            with contextlib.suppress(FileNotFoundError):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        # trimmed a bit below max_bytes, so a full cache isn't scanned every store
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9 if total > self.max_bytes else self.max_bytes
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+        self._total = total
+
+
+avatar_cache = (
+    AvatarCache(
+        config.avatar_cache_dir,
+        getattr(config, "avatar_cache_max_bytes", 64 * 1024 * 1024),
+    )
+    if getattr(config, "avatar_cache_dir", None)
+    else None
+)
+
+
+# Avatars are downloaded concurrently, but only so many at once across every game
+AVATAR_FETCH_CONCURRENCY = getattr(config, "avatar_fetch_concurrency", 8)
+AVATAR_FETCH_TIMEOUT = getattr(config, "avatar_fetch_timeout", 5)
+_avatar_fetches: typing.Optional[asyncio.Semaphore] = None
+
+
+async def fetch_avatar(member: discord.Member) -> typing.Optional[bytes]:
+    global _avatar_fetches
+    if _avatar_fetches is None:
+        _avatar_fetches = asyncio.Semaphore(AVATAR_FETCH_CONCURRENCY)
+
+    async with _avatar_fetches:
+        try:
+            return await asyncio.wait_for(
+                member.avatar_url_as(format="png", size=128).read(),
+                AVATAR_FETCH_TIMEOUT,
+            )
+        except (asyncio.TimeoutError, aiohttp.ClientError, discord.DiscordException):
+            # the worker will use a placeholder instead
+            render_stats.count("avatar_fetch_failures")
+            return None
 
 
 async def serialize_player(p: Player, ia: bool) -> dict:
-    if ia:
-        b = io.BytesIO()
-        await p.member.avatar_url_as(format="png", size=128).save(b)
+    key = AvatarCache.key(p.member)
+    if avatar_cache is not None and key in avatar_cache:
+        # the worker can get their avatar from the cache, no need to download it
+        ia = False
 
     return {
         "ni": p.member.nick,
@@ -102,171 +1225,70 @@ async def serialize_player(p: Player, ia: bool) -> dict:
         "i": p.member.id,
         "d": p.dead,
         "r": str(p.role),
-        "a": b if ia else None,  # noqa
+        "c": p.role.cleaned,
+        "a": await fetch_avatar(p.member) if ia else None,  # noqa
+        "k": key,
     }
 
 
-async def serialize_game(g: MafiaGame, include_avatars=False) -> dict:
+async def serialize_game(
+    g: MafiaGame, include_avatars=False, prefetched: typing.Collection[int] = ()
+) -> dict:
     return {
-        "p": [await serialize_player(p, include_avatars) for p in g.players],
+        "p": await asyncio.gather(
+            *(
+                # the worker already has the avatars that were prefetched
+                serialize_player(p, include_avatars and p.member.id not in prefetched)
+                for p in g.players
+            )
+        ),
         "d": g._day,  # noqa
     }
 
 
 class GameProcessor(multiprocessing.Process):
     def run(self) -> None:
+        # the rendering code is only ever imported in the workers
+        from utils import rendering
+
         pipe = self._args[0]  # noqa
-        avatars = {}  # cache the avatar images throughout the game
-        data: dict = (
-            pipe.recv()
-        )  # receives the initial game dump, with the avatars. Avatars won't be sent in later updates
-        game: dict = data["g"]
-        for player in game["p"]:
-            # turns the bytesio into image objects and applies the rounding masks
-            avatars[player["i"]] = round_avatar(player["a"])
+        state = rendering.RenderState()
+        rendering.preload()
 
         while True:
-            d = pipe.recv()
-            if d["op"] == 0:  # nighttime images
-                resp = _sync_make_night_image(d["d"])
-            elif d["op"] == 1:  # daytime images
-                game.update(d["g"])
-                deaths = d["d"]
-                resp = _sync_make_day_image(game, deaths, avatars)
-            else:
-                raise RuntimeError("unknown opcode")
-
-            pipe.send(resp)
-
+            try:
+                frame = pipe.recv_bytes()
+            except EOFError:
+                # the bot has closed its end of the pipe
+                return
 
-def _sync_make_night_image(night: int) -> io.BytesIO:
-    base: Image.Image = Image.open("./resources/background-night.png", formats=("png",))
-    base = base.resize((1920, 1080))
-    raster = ImageDraw.Draw(base)
+            version, op, job = _REQUEST.unpack_from(frame)
+            start = time.perf_counter()
+            rendering.job_timings.encode = 0
+            try:
+                if version != PROTOCOL_VERSION:
+                    raise RuntimeError(f"unsupported protocol version {version}")
+                result = state.handle(op, memoryview(frame)[_REQUEST.size :])
+            except Exception as e:
+                # send the error back to the game rather than dying
+                result = e
 
-    __w, _ = raster.textsize(f"Night {night}", font=font_28days_title)  # noqa
-    raster.text(
-        ((1920 - __w) / 2, 30), f"Night {night}", font=font_28days_title, fill="black"
-    )  # noqa center the night #
+            busy = time.perf_counter() - start
+            encode = rendering.job_timings.encode
+            pipe.send_bytes(encode_response(job, result, busy, encode))
 
-    buf = io.BytesIO()
-    base.save(buf, format="png")
-    buf.seek(0)
-    base.close()
-    return buf
 
+def prefetch_avatar(game: MafiaGame, member: discord.Member):
+    render_pool.prefetch_avatar(game, member)
 
-def _sync_make_day_image(
-    game: dict, deaths: typing.List[int], avatars: dict
-) -> io.BytesIO:
-    base: Image.Image = Image.open("./resources/background-day.png", formats=("png",))
-    base = base.resize((1920, 1080)).convert("RGBA")
-    raster = ImageDraw.Draw(base)
-
-    alive = list(filter(lambda player: not player["d"], game["p"]))
-    dead = list(
-        filter(lambda player: player["d"] and player["i"] not in deaths, game["p"])
-    )
-
-    __w, _ = raster.textsize(f"Day {game['d']}", font=font_28days_title)  # noqa
-    raster.text(
-        ((1920 - __w) / 2, 30), f"Day {game['d']}", font=font_28days_title, fill="black"
-    )  # noqa center the day #
-    raster.text(
-        (30, 260),
-        f"Alive Players",
-        font=font_28days,
-    )  # noqa put this above row 1
-
-    row_width = 105  # how far apart each row is
-    col_width = 400  # how far apart each column is
-    row = col = 0  # row is up/down, col(umn) is left/right
-
-    def paste_avatar(player: dict, text_fill: str, do_x: bool, show_role: bool):
-        nonlocal col, row
-        avy = avatars[player["i"]]
-
-        # determine the co-ords based off the column and row
-        x = (
-            30 + (col * col_width),
-            int(330 + (row_width * row)),
-            30 + avy.size[0] + (col * col_width),
-            int(330 + (row_width * row) + avy.size[1]),
-        )
-
-        base.paste(avy, x, mask=avy)
-        if do_x:
-            # paste the red x across their avatar
-            base.paste(death_marker, x, mask=death_marker)
-
-        # if they have a nick, format as `nick (name)`, else just the name
-        nick = f"{player['ni'] + ' ' if player['ni'] else ''}{'(' + player['na'] + ')' if player['ni'] else player['na']}"
-        if len(nick) >= 17:
-            # nick is too long, shorten it
-            nick = nick[:17] + "..."
-
-        if show_role:
-            # add their role to the nick text
-            nick += f"\n\t{player['r']}"
-            t = (
-                x[2] + 20,
-                int(330 + (row_width * row)),
-            )  # don't bother centering as there's 2 lines of text which centers itself
-
-        else:
-            _, _h = raster.textsize(nick, font=font_vermillion)
-            t = (x[2] + 20, int(330 + (row_width * row) + (_h / 2)))  # center the text
-
-        raster.text(t, nick, font=font_vermillion, fill=text_fill)
-        row += 1
-        if row >= 7:
-            # 7 people per row, jump to the next column
-            row = 0
-            col += 1
-
-    if deaths:
-        # these are the people who have died today
-        d = [discord.utils.find(lambda pl: pl["i"] == x, game["p"]) for x in deaths]
-        for p in d:
-            # fill certain slots with black text to contrast the background
-            fill = "black" if col >= 1 and 3 > row > 0 else "white"
-            paste_avatar(p, fill, True, True)
-
-    for p in alive:
-        # fill certain slots with black text to contrast the background
-        fill = "black" if col >= 1 and 3 > row > 0 else "white"
-        paste_avatar(p, fill, False, False)
-
-    if dead:
-        if row:
-            # if we're not in an empty column, jump to a new one
-            col += 1
-            row = 0
-
-        raster.text(
-            (30 + (col * col_width), 260),
-            f"Dead Players",
-            font=font_28days,
-            fill="black",
-        )
-        for p in dead:
-            # fill certain slots with black text to contrast the background
-            fill = (
-                "black"
-                if (col >= 1 and row == 2) or (col == 3 and (row == 0 or row == 2))
-                else "white"
-            )
-            paste_avatar(p, fill, True, True)
 
-    buf = io.BytesIO()
-    base.save(buf, format="png")
-    buf.seek(0)
-    base.close()
-    return buf
+def discard_avatar(game: MafiaGame, user_id: int):
+    render_pool.discard_avatar(game, user_id)
 
 
-def cleanup_game(game: MafiaGame):
-    g_id = id(game)
-    if g_id in processes:
-        proc = processes.pop(g_id)
-        proc.terminate()
+async def cleanup_game(game: MafiaGame):
+    # this happens before the game's channels are deleted, anything sent in them
+    # can't be pointed at anymore
+    if category := getattr(game, "category", None):
+        attachments.forget_channels({channel.id for channel in category.channels})
+    await render_pool.drop(game)
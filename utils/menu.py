@@ -149,8 +149,10 @@ class MafiaMenu(menus.MenuPages):
             return
 
         msg = await self.ctx.send(f"{role.__name__}: How many? 0 - {amt_allowed}")
-        answer = await self.ctx.bot.wait_for(
-            "message", check=min_max_check(self.ctx, 0, amt_allowed)
+        answer = await self.ctx.bot.wait_for_message(
+            self.ctx.channel,
+            author=self.ctx.author,
+            check=min_max_check(self.ctx, 0, amt_allowed),
         )
         # Delete and set answer
         self.source.entries[index] = (role, int(answer.content))
@@ -0,0 +1,511 @@
+"""The rendering side of the imaging pipeline. This is only imported by the render
+workers, so the bot process never has to load PIL, the fonts or the backgrounds"""
+from __future__ import annotations
+
+import collections
+import contextlib
+import functools
+import io
+import pickle
+import threading
+import time
+import typing
+
+import numpy
+from PIL import Image, ImageDraw, ImageFont
+
+from utils.imaging import (
+    OP_AVATARS,
+    OP_DAY,
+    OP_DROP,
+    OP_NIGHT,
+    OP_REGISTER,
+    PLAYER_CLEANED,
+    PLAYER_DEAD,
+    _NIGHT,
+    avatar_cache,
+    decode_day,
+)
+from utils import imaging
+
+alpha = None
+# fonts are only loaded the first time they're used
+TITLE_FONT = ("28 Days Later", 256)
+HEADER_FONT = ("28 Days Later", 64)
+LABEL_FONT = ("Vermillion", 34)
+
+
+@functools.lru_cache(maxsize=None)
+def font(name: str, size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(f"./resources/{name}.ttf", size=size)
+
+
+@functools.lru_cache(maxsize=None)
+def death_marker() -> Image.Image:
+    return Image.open("./resources/death-marker.png", formats=("png",)).resize((96, 96))
+
+
+# The backgrounds, decoded and resized once per worker. Renders draw on a copy
+_backgrounds: typing.Dict[str, Image.Image] = {}
+
+
+def background(name: str) -> Image.Image:
+    if name not in _backgrounds:
+        base = Image.open(f"./resources/background-{name}.png", formats=("png",))
+        base = base.resize((1920, 1080))
+        # the day image has avatars pasted onto it, which need the alpha channel
+        _backgrounds[name] = base.convert("RGBA") if name == "day" else base
+
+    return _backgrounds[name]
+
+
+def preload():
+    """Loads everything a render needs up front, so the first render doesn't pay for it"""
+    for name in ("day", "night"):
+        # a missing background should only break the images that use it
+        with contextlib.suppress(OSError):
+            background(name)
+
+    for f in (TITLE_FONT, HEADER_FONT, LABEL_FONT):
+        font(*f)
+    death_marker()
+    avatar_mask()
+
+
+class _JobTimings(threading.local):
+    encode = 0.0
+
+
+# How long encoding took for the current job, the worker reports it back to the bot.
+# It's per thread, as the thread backend has several workers in the one process
+job_timings = _JobTimings()
+
+
+def encode_image(image: Image.Image, tier: int = 0) -> io.BytesIO:
+    start = time.perf_counter()
+    if tier:
+        # drawing is cheap compared to encoding, so it's only shrunk right before
+        image = image.resize(imaging.RENDER_TIERS[tier], Image.BILINEAR)
+    if imaging.OUTPUT_FORMAT == "png":
+        # png is lossless, the best we can do to meet the budget is compress harder
+        image_format = "PNG"
+        attempts = [
+            {"compress_level": imaging.OUTPUT_PNG_COMPRESS_LEVEL},
+            {"compress_level": 9},
+        ]
+    else:
+        # no need for the alpha channel, none of the images are transparent
+        image = image.convert("RGB")
+        image_format = imaging.OUTPUT_FORMAT.upper()
+        # the configured quality first, then lower until the floor
+        qualities = range(
+            imaging.OUTPUT_QUALITY - 10, imaging.OUTPUT_MIN_QUALITY - 1, -10
+        )
+        attempts = [{"quality": q} for q in (imaging.OUTPUT_QUALITY, *qualities)]
+
+    for kwargs in attempts:
+        buf = io.BytesIO()
+        image.save(buf, format=image_format, **kwargs)
+        if imaging.OUTPUT_MAX_BYTES is None or buf.tell() <= imaging.OUTPUT_MAX_BYTES:
+            break
+
+    buf.seek(0)
+    job_timings.encode += time.perf_counter() - start
+    return buf
+
+
+def add_corners(im, rad):
+    if im.size != (128, 128):
+        im = im.resize((128, 128))
+
+    global alpha
+    if not alpha:  # cache the alpha layer
+        circle = Image.new("L", (rad * 2, rad * 2), 0)
+        draw = ImageDraw.Draw(circle)
+        draw.ellipse((0, 0, rad * 2, rad * 2), fill=255)
+        alpha = Image.new("L", im.size, 255)
+        alpha.paste(circle.crop((0, 0, rad, rad)), (0, 0))
+        alpha.paste(circle.crop((0, rad, rad, rad * 2)), (0, im.size[0] - rad))
+        alpha.paste(circle.crop((rad, 0, rad * 2, rad)), (128 - rad, 0))
+        alpha.paste(
+            circle.crop((rad, rad, rad * 2, rad * 2)),
+            (im.size[0] - rad, im.size[0] - rad),
+        )
+
+    im.putalpha(alpha)
+    return im.resize((96, 96))  # resize it to a more respectable size
+
+
+def round_avatar(avy: io.BytesIO, rad=64) -> Image:
+    return add_corners(Image.open(avy, formats=("png",)), rad)
+
+
+_avatar_mask: typing.Optional[numpy.ndarray] = None
+
+
+def avatar_mask() -> numpy.ndarray:
+    """The same rounding mask add_corners uses, at the size avatars end up at"""
+    global _avatar_mask
+    if _avatar_mask is None:
+        if not alpha:
+            add_corners(Image.new("RGB", (128, 128)), 64)  # builds the alpha layer
+        _avatar_mask = numpy.asarray(alpha.resize((96, 96)))
+
+    return _avatar_mask
+
+
+def round_avatars(
+    avatars: typing.List[bytes],
+) -> typing.List[typing.Optional[Image.Image]]:
+    """Rounds a batch of avatars at once. They're decoded and resized straight to
+    their final size, stacked into one array, and the mask is applied to all of
+    them in a single operation. Any that can't be decoded come back as None"""
+    if not avatars:
+        return []
+
+    batch = numpy.empty((len(avatars), 96, 96, 4), dtype=numpy.uint8)
+    decoded = []
+    for i, avy in enumerate(avatars):
+        try:
+            # the alpha channel is about to be replaced, only the colours are resized
+            avy = Image.open(io.BytesIO(avy), formats=("png",)).convert("RGB")
+            batch[i, ..., :3] = numpy.asarray(avy.resize((96, 96)))
+        except (OSError, ValueError):
+            # one broken avatar shouldn't take the rest of the game down with it
+            decoded.append(False)
+        else:
+            decoded.append(True)
+    batch[..., 3] = avatar_mask()
+
+    return [Image.fromarray(tile) if ok else None for tile, ok in zip(batch, decoded)]
+
+
+def cache_avatars(
+    keys: typing.List[str], avatars: typing.List[typing.Optional[Image.Image]]
+):
+    if avatar_cache is not None:
+        for key, avatar in zip(keys, avatars):
+            if avatar is None:
+                continue  # so it's tried again next time
+            buf = io.BytesIO()
+            avatar.save(buf, format="png")
+            avatar_cache.store(key, buf.getvalue())
+
+
+def load_avatars(
+    players: typing.List[dict],
+    prefetched: typing.Optional[typing.Dict[int, Image.Image]] = None,
+) -> typing.Dict[int, Image.Image]:
+    """Gets the rounded avatars for serialized players, from the ones sent ahead of
+    the game or the cache for anyone the bot didn't send an avatar over for"""
+    sent = [player for player in players if player["a"] is not None]
+    avatars = dict(zip((p["i"] for p in sent), round_avatars([p["a"] for p in sent])))
+    cache_avatars([p["k"] for p in sent], [avatars[p["i"]] for p in sent])
+
+    for player in players:
+        if avatars.get(player["i"]) is not None:
+            continue
+        if prefetched and player["i"] in prefetched:
+            avatars[player["i"]] = prefetched[player["i"]]
+        elif avatar_cache is not None and (data := avatar_cache.load(player["k"])):
+            avatars[player["i"]] = Image.open(io.BytesIO(data), formats=("png",))
+        else:
+            avatars[player["i"]] = placeholder_avatar()
+
+    return avatars
+
+
+def placeholder_avatar() -> Image.Image:
+    # used when we couldn't get someone's avatar in time
+    return add_corners(Image.new("RGBA", (128, 128), (114, 137, 218, 255)), 64)
+
+
+class RenderState:
+    """The state a render worker keeps for each of the games pinned to it"""
+
+    def __init__(self):
+        self.games: typing.Dict[str, dict] = {}
+        # cache the avatar images throughout the game
+        self.avatars: typing.Dict[str, typing.Dict[int, Image.Image]] = {}
+        self.renderers: typing.Dict[str, DayRenderer] = {}
+        # avatars sent while people were still joining, by user id
+        self.prefetched: typing.Dict[
+            str, typing.Dict[int, Image.Image]
+        ] = collections.defaultdict(dict)
+
+    def handle(self, op: int, body: memoryview) -> typing.Optional[io.BytesIO]:
+        if op == OP_NIGHT:  # nighttime images
+            (night,) = _NIGHT.unpack_from(body)
+            return _sync_make_night_image(night)
+        elif op == OP_DAY:  # daytime images
+            handle, day, deaths, changes, tier = decode_day(body)
+            game = self.games[handle]
+            game["d"] = day
+            for index, flags, role in changes:
+                player = game["p"][index]
+                player["d"] = bool(flags & PLAYER_DEAD)
+                player["c"] = bool(flags & PLAYER_CLEANED)
+                if role is not None:
+                    player["r"] = role
+            return self.renderers[handle].render(game, deaths, tier)
+        elif op == OP_REGISTER:
+            # receives the initial game dump, with the avatars. Avatars won't be sent in later updates
+            handle = bytes(body[:16]).hex()
+            game = self.games[handle] = pickle.loads(body[16:])
+            # turns the avatars into image objects and applies the rounding masks
+            self.avatars[handle] = load_avatars(
+                game["p"], self.prefetched.pop(handle, None)
+            )
+            self.renderers[handle] = DayRenderer(self.avatars[handle])
+        elif op == OP_AVATARS:
+            # rounded now, rather than all at once when the game starts
+            handle = bytes(body[:16]).hex()
+            sent = pickle.loads(body[16:])
+            keys, data = zip(*sent.values())
+            avatars = round_avatars(list(data))
+            cache_avatars(list(keys), avatars)
+            self.prefetched[handle].update(
+                (uid, avatar or placeholder_avatar())
+                for uid, avatar in zip(sent, avatars)
+            )
+        elif op == OP_DROP:
+            handle = bytes(body[:16]).hex()
+            self.prefetched.pop(handle, None)
+            self.games.pop(handle, None)
+            self.avatars.pop(handle, None)
+            self.renderers.pop(handle, None)
+        else:
+            raise RuntimeError("unknown opcode")
+
+
+def _sync_make_night_image(night: int) -> io.BytesIO:
+    base = draw_night_image(night)
+    buf = encode_image(base)
+    base.close()
+    return buf
+
+
+def draw_night_image(night: int) -> Image.Image:
+    base = background("night").copy()
+    raster = ImageDraw.Draw(base)
+
+    __w, _ = raster.textsize(f"Night {night}", font=font(*TITLE_FONT))  # noqa
+    raster.text(
+        ((1920 - __w) / 2, 30), f"Night {night}", font=font(*TITLE_FONT), fill="black"
+    )  # noqa center the night #
+
+    return base
+
+
+# The day image is laid out as a grid of slots, each one holding an avatar and its label
+ROW_HEIGHT = 105  # how far apart each row is
+COL_WIDTH = 400  # how far apart each column is
+ROWS = 7  # 7 people per column
+TITLE_HEIGHT = 260  # everything above this is the day title
+HEADER_HEIGHT = 70  # the "Alive Players"/"Dead Players" headers above the slots
+
+Rect = typing.Tuple[int, int, int, int]
+
+
+def _player_label(player: dict, show_role: bool) -> str:
+    # if they have a nick, format as `nick (name)`, else just the name
+    nick = f"{player['ni'] + ' ' if player['ni'] else ''}{'(' + player['na'] + ')' if player['ni'] else player['na']}"
+    if len(nick) >= 17:
+        # nick is too long, shorten it
+        nick = nick[:17] + "..."
+
+    if show_role:
+        # add their role to the nick text
+        nick += f"\n\t{player['r']}"
+
+    return nick
+
+
+class DayLayout(typing.NamedTuple):
+    """Where everything goes on the day image. Each player slot is its area and
+    the colour of the text in it, which depends on what's behind it"""
+
+    headers: typing.Tuple[typing.Tuple[Rect, str, str], ...]  # area, text, colour
+    deaths: typing.Tuple[typing.Tuple[Rect, str], ...]  # people who died last night
+    alive: typing.Tuple[typing.Tuple[Rect, str], ...]
+    dead: typing.Tuple[typing.Tuple[Rect, str], ...]
+
+
+@functools.lru_cache(maxsize=None)
+def day_layout(deaths: int, alive: int, dead: int) -> DayLayout:
+    """Works out the layout for this many of each kind of player. It only depends
+    on the amounts, so it's only worked out once"""
+    row = col = 0  # row is up/down, col(umn) is left/right
+
+    def header() -> Rect:
+        x = 30 + (col * COL_WIDTH)
+        return x, TITLE_HEIGHT, x + COL_WIDTH, TITLE_HEIGHT + HEADER_HEIGHT
+
+    def slot(dead_section: bool) -> typing.Tuple[Rect, str]:
+        nonlocal col, row
+        # determine the co-ords based off the column and row
+        x = 30 + (col * COL_WIDTH)
+        y = TITLE_HEIGHT + HEADER_HEIGHT + (row * ROW_HEIGHT)
+        # certain slots get black text to contrast the background
+        if dead_section:
+            black = (col >= 1 and row == 2) or (col == 3 and (row == 0 or row == 2))
+        else:
+            black = col >= 1 and 3 > row > 0
+
+        row += 1
+        if row >= ROWS:
+            # jump to the next column
+            row = 0
+            col += 1
+
+        return (x, y, x + COL_WIDTH, y + ROW_HEIGHT), "black" if black else "white"
+
+    headers = [(header(), "Alive Players", "white")]  # put this above row 1
+    death_slots = tuple(slot(False) for _ in range(deaths))
+    alive_slots = tuple(slot(False) for _ in range(alive))
+
+    dead_slots = ()
+    if dead:
+        if row:
+            # if we're not in an empty column, jump to a new one
+            col += 1
+            row = 0
+
+        headers.append((header(), "Dead Players", "black"))
+        dead_slots = tuple(slot(True) for _ in range(dead))
+
+    return DayLayout(tuple(headers), death_slots, alive_slots, dead_slots)
+
+
+def _day_slots(game: dict, deaths: typing.List[int]) -> typing.Dict[Rect, tuple]:
+    """Works out what goes in every slot of the day image. Slots are keyed by the
+    area of the image they take up, so they can be compared between days"""
+    players = {player["i"]: player for player in game["p"]}
+    # these are the people who have died today
+    died = [players[x] for x in deaths]
+    alive = [player for player in game["p"] if not player["d"]]
+    dead = [p for p in game["p"] if p["d"] and p["i"] not in deaths]
+
+    layout = day_layout(len(died), len(alive), len(dead))
+    slots: typing.Dict[Rect, tuple] = {
+        rect: ("h", text, fill) for rect, text, fill in layout.headers
+    }
+    for section, places, is_dead in (
+        (died, layout.deaths, True),
+        (alive, layout.alive, False),
+        (dead, layout.dead, True),
+    ):
+        # the dead get the red x and have their role shown
+        for player, (rect, fill) in zip(section, places):
+            label = _player_label(player, is_dead)
+            slots[rect] = ("p", player["i"], label, is_dead, is_dead, fill)
+
+    return slots
+
+
+class DayRenderer:
+    """Keeps the last day image drawn for a game, so that the next day only has to
+    redraw the day title and the slots that changed since then"""
+
+    def __init__(self, avatars: typing.Dict[int, Image.Image]):
+        self.avatars = avatars
+        self.board: typing.Optional[Image.Image] = None
+        self.slots: typing.Dict[Rect, tuple] = {}
+        # avatars with the red x already across them, made the first time they die
+        self.dead_avatars: typing.Dict[int, Image.Image] = {}
+        # labels never change during a game, so they're only rasterized once
+        self.labels: typing.Dict[
+            tuple, typing.Tuple[Image.Image, typing.Tuple[int, int]]
+        ] = {}
+
+    def _dead_avatar(self, player_id: int) -> Image.Image:
+        if player_id not in self.dead_avatars:
+            # the red x across their avatar
+            self.dead_avatars[player_id] = Image.alpha_composite(
+                self.avatars[player_id], death_marker()
+            )
+
+        return self.dead_avatars[player_id]
+
+    def _label(
+        self,
+        text: str,
+        font: ImageFont.FreeTypeFont,
+        size: typing.Tuple[int, int],
+        center: bool,
+    ) -> typing.Tuple[Image.Image, typing.Tuple[int, int]]:
+        """Returns the text as a mask, along with where it goes in its area. The
+        fill is applied when the mask is pasted, so it works for any colour"""
+        key = (text, font, size, center)
+        if key not in self.labels:
+            mask = Image.new("L", size)
+            raster = ImageDraw.Draw(mask)
+            y = 0
+            if center:
+                _, _h = raster.textsize(text, font=font)
+                y = int(_h / 2)  # center the text
+            raster.text((0, y), text, font=font, fill=255)
+
+            # only keep the part with text in it, there's no point pasting the rest
+            box = mask.getbbox() or (0, 0, 1, 1)
+            self.labels[key] = mask.crop(box), box[:2]
+
+        return self.labels[key]
+
+    def _draw_slot(self, rect: Rect, slot: typing.Optional[tuple]):
+        # everything is drawn onto a tile the size of the slot, that way nothing
+        # drawn can spill over onto a neighbouring slot that may not be redrawn
+        tile = background("day").crop(rect)
+
+        if slot is None:
+            # this slot is now empty, it just needs the background back
+            pass
+        elif slot[0] == "h":
+            _, text, fill = slot
+            mask, pos = self._label(text, font(*HEADER_FONT), tile.size, False)
+            tile.paste(fill, pos, mask=mask)
+        else:
+            _, player_id, label, do_x, show_role, fill = slot
+            avy = self._dead_avatar(player_id) if do_x else self.avatars[player_id]
+            tile.paste(avy, (0, 0), mask=avy)
+
+            # don't bother centering the role text as there's 2 lines of text which centers itself
+            x = avy.size[0] + 20
+            mask, (mx, my) = self._label(
+                label, font(*LABEL_FONT), (tile.width - x, tile.height), not show_role
+            )
+            tile.paste(fill, (x + mx, my), mask=mask)
+
+        self.board.paste(tile, rect[:2])
+
+    def _draw_title(self, day: int):
+        # the title changes every day
+        title = background("day").crop((0, 0, 1920, TITLE_HEIGHT))
+        raster = ImageDraw.Draw(title)
+        __w, _ = raster.textsize(f"Day {day}", font=font(*TITLE_FONT))  # noqa
+        raster.text(
+            ((1920 - __w) / 2, 30),
+            f"Day {day}",
+            font=font(*TITLE_FONT),
+            fill="black",
+        )  # noqa center the day #
+        self.board.paste(title, (0, 0))
+
+    def draw(self, game: dict, deaths: typing.List[int]) -> Image.Image:
+        if self.board is None:
+            self.board = background("day").copy()
+
+        slots = _day_slots(game, deaths)
+        # only the slots that are different from last time need to be drawn again
+        for rect in self.slots.keys() - slots.keys():
+            self._draw_slot(rect, None)
+        for rect, slot in slots.items():
+            if self.slots.get(rect) != slot:
+                self._draw_slot(rect, slot)
+        self.slots = slots
+        self._draw_title(game["d"])
+
+        return self.board
+
+    def render(self, game: dict, deaths: typing.List[int], tier: int = 0) -> io.BytesIO:
+        return encode_image(self.draw(game, deaths), tier)